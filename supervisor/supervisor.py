@@ -2,7 +2,7 @@
 """OpenClaw Supervisor Bot — standalone Telegram bot that runs Claude Code CLI.
 
 Features:
-  - Telegram long-polling (stdlib only, zero deps)
+  - Telegram long-polling (stdlib only, zero deps; uses orjson if installed)
   - Claude Code CLI subprocess with streaming responses
   - Session continuity via --resume
   - Proactive health watchdog (alerts on gateway/relay down)
@@ -11,10 +11,19 @@ Features:
   - Native Claude auto-memory (CLAUDE.md + ~/.claude/projects/)
 """
 
+import collections
+import concurrent.futures
+import functools
+import http.client
+import itertools
 import json
 import logging
 import os
+import re
+import select
+import shutil
 import signal
+import socket
 import subprocess
 import sys
 import tempfile
@@ -25,6 +34,11 @@ import urllib.parse
 import urllib.request
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- Config ---
 
 BOT_TOKEN = os.environ.get("SUPERVISOR_BOT_TOKEN", "")
@@ -32,6 +46,9 @@ ALLOWED_USER = int(os.environ.get("SUPERVISOR_ALLOWED_USER", "5021811410"))
 CLAUDE_BIN = os.environ.get("CLAUDE_BIN", str(Path.home() / ".local" / "bin" / "claude"))
 SYSTEM_PROMPT_PATH = Path(__file__).resolve().parent / "system-prompt.md"
 SUPERVISOR_DIR = Path(__file__).resolve().parent
+STATE_PATH = Path.home() / ".openclaw" / "supervisor-state.json"
+CLAUDE_ERR_LOG = Path.home() / ".openclaw" / "logs" / "claude.err.log"
+CLAUDE_ERR_MAX = 1 << 20  # rotate claude.err.log to .1 past this size
 
 # Supertonic TTS
 TTS_SCRIPT = Path.home() / "supertonic" / "py" / "tts_stdout.py"
@@ -40,9 +57,17 @@ TTS_VOICE_STYLE = Path.home() / "supertonic" / "assets" / "voice_styles" / "F1.j
 TTS_PYTHON = "/usr/local/bin/python3.11"
 
 CLAUDE_TIMEOUT = 300
-POLL_TIMEOUT = 30
+POLL_TIMEOUT = 25  # getUpdates long-poll window
+HTTP_TIMEOUT = POLL_TIMEOUT + 15  # socket timeout, with headroom over the poll window
 MAX_MSG_LEN = 4000
+STREAM_READ_SIZE = 1 << 16  # bytes per os.read() of Claude's stdout
 HEALTH_CHECK_INTERVAL = 60  # seconds
+MAX_CHATS = 256  # per-chat state kept for the most recently active chats
+HEALTH_CACHE_TTL = 10  # seconds; absorbs bursts of /status and button taps
+
+# Resolved once so health checks don't walk $PATH on every exec
+LAUNCHCTL = shutil.which("launchctl") or "/bin/launchctl"
+LSOF = shutil.which("lsof") or "/usr/sbin/lsof"
 
 logging.basicConfig(
     level=logging.INFO,
@@ -51,50 +76,217 @@ logging.basicConfig(
 )
 log = logging.getLogger("supervisor")
 
+# Both accept bytes and raise a ValueError subclass on bad input
+_json_loads = orjson.loads if orjson else json.loads
+
+
+def _json_dumps(obj):
+    """Serialize to UTF-8 JSON bytes."""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
 # --- Telegram helpers (stdlib only) ---
 
+TG_HOST = "api.telegram.org"
+# Read size for file parts of multipart bodies. http.client's blocksize only
+# applies to file-like bodies, which we never pass: bytes go out in one
+# sendall and _stream_parts yields blocks of this size itself.
+UPLOAD_BLOCKSIZE = 1 << 16
+TG_POOL_MAXSIZE = 4  # idle connections kept
+TG_IDLE_TIMEOUT = 60  # seconds; older idle connections are likely closed server-side
+
+# Idle keep-alive connections to TG_HOST. poll_loop, watchdog_loop and the
+# Claude worker all call tg(), so each call checks out its own connection
+# instead of sharing one (a 30s long-poll would otherwise block every send).
+_tg_idle = []  # [(conn, last_used)]
+_tg_idle_lock = threading.Lock()
+
+
+def _tg_connect(timeout):
+    return http.client.HTTPSConnection(TG_HOST, timeout=timeout)
+
+
+def _part_len(part):
+    # seek() flushes any buffered writes, so the length matches what streams out
+    return len(part) if isinstance(part, bytes) else part.seek(0, os.SEEK_END)
+
+
+def _stream_parts(parts):
+    """Yield a body made of bytes and file parts; files go out in UPLOAD_BLOCKSIZE reads."""
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+            continue
+        part.seek(0)
+        while True:
+            block = part.read(UPLOAD_BLOCKSIZE)
+            if not block:
+                break
+            yield block
+
+
+def _tg_request(method, body, content_type, timeout, query=None):
+    """Call the Bot API over a pooled keep-alive connection.
+
+    POSTs `body`: bytes, or a list of bytes/file parts streamed without
+    joining. With `query` (and body None) it sends a bodyless GET instead.
+    Returns (status, response_bytes). Raises on network errors.
+    """
+    conn = None
+    now = time.monotonic()
+    with _tg_idle_lock:
+        while _tg_idle:
+            candidate, last_used = _tg_idle.pop()
+            if now - last_used < TG_IDLE_TIMEOUT:
+                conn = candidate
+                break
+            candidate.close()
+    reused = conn is not None
+    if conn is None:
+        conn = _tg_connect(timeout)
+    path = f"/bot{BOT_TOKEN}/{method}"
+    verb = "POST"
+    headers = {"Connection": "keep-alive"}
+    if query is not None:
+        verb, path = "GET", f"{path}?{query}"
+    else:
+        headers["Content-Type"] = content_type
+    if isinstance(body, list):
+        headers["Content-Length"] = str(sum(_part_len(p) for p in body))
+
+    def attempt(c):
+        # A list body is re-streamed from the start on every attempt
+        c.request(verb, path, body=_stream_parts(body) if isinstance(body, list) else body,
+                  headers=headers)
+        return c.getresponse()
+
+    try:
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        else:
+            conn.timeout = timeout
+        resp = attempt(conn)
+    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        conn.close()
+        if not reused:
+            raise
+        # Telegram dropped the idle connection; retry once on a fresh one
+        conn = _tg_connect(timeout)
+        try:
+            resp = attempt(conn)
+        except Exception:
+            conn.close()
+            raise
+    except Exception:
+        conn.close()
+        raise
+
+    try:
+        data = resp.read()
+    except Exception:
+        conn.close()
+        raise
+    keep = not resp.will_close
+    if keep:
+        with _tg_idle_lock:
+            keep = len(_tg_idle) < TG_POOL_MAXSIZE
+            if keep:
+                _tg_idle.append((conn, time.monotonic()))
+    if not keep:
+        conn.close()
+    return resp.status, data
+
+
 def tg(method, **params):
     """Call a Telegram Bot API method. Returns parsed JSON or None."""
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
-    data = json.dumps({k: v for k, v in params.items() if v is not None}).encode()
-    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    return _tg_json(method, params)
+
+
+# The only update types poll_loop handles; Telegram filters out the rest
+ALLOWED_UPDATES = ["message", "callback_query"]
+UPDATES_LIMIT = 100
+
+
+# getUpdates query string with only the offset left to append
+_GET_UPDATES_QUERY = urllib.parse.urlencode({
+    "timeout": POLL_TIMEOUT, "limit": UPDATES_LIMIT,
+    "allowed_updates": json.dumps(ALLOWED_UPDATES, separators=(",", ":")),
+}) + "&offset="
+
+
+def tg_longpoll(offset):
+    """Long-poll getUpdates. An expired poll window is an empty batch, not an error."""
+    # A bodyless GET: no JSON to build here or for Telegram to parse
+    return _tg_raw("getUpdates", None, quiet_timeout=True, query=f"{_GET_UPDATES_QUERY}{offset}")
+
+
+def _tg_json(method, params):
+    return _tg_raw(method, _json_dumps({k: v for k, v in params.items() if v is not None}))
+
+
+def _tg_raw(method, data, quiet_timeout=False, query=None):
+    """POST an already-serialized JSON body, or GET `query` with data None.
+
+    Returns parsed JSON or None.
+    """
     try:
-        with urllib.request.urlopen(req, timeout=POLL_TIMEOUT + 10) as resp:
-            return json.loads(resp.read())
-    except urllib.error.HTTPError as e:
-        body = e.read().decode(errors="replace")
-        log.error("Telegram %s error %s: %s", method, e.code, body)
+        status, body = _tg_request(method, data, "application/json", HTTP_TIMEOUT, query=query)
+    except socket.timeout as e:
+        if quiet_timeout:
+            return {"ok": True, "result": []}
+        log.error("Telegram %s timed out: %s", method, e)
         return None
     except Exception as e:
         log.error("Telegram %s failed: %s", method, e)
         return None
+    if status != 200:
+        log.error("Telegram %s error %s: %s", method, status, body.decode(errors="replace"))
+        return None
+    try:
+        return _json_loads(body)
+    except ValueError as e:
+        log.error("Telegram %s bad response: %s", method, e)
+        return None
+
+
+_MP_BOUNDARY = "----SupervisorBoundary"
+_MP_CONTENT_TYPE = f"multipart/form-data; boundary={_MP_BOUNDARY}"
+_MP_FIELD = f"--{_MP_BOUNDARY}\r\nContent-Disposition: form-data; name=\"{{}}\"\r\n\r\n{{}}\r\n"
+_MP_FILE = (f"--{_MP_BOUNDARY}\r\nContent-Disposition: form-data; name=\"{{}}\"; filename=\"{{}}\"\r\n"
+            "Content-Type: {}\r\n\r\n")
+_MP_END = f"--{_MP_BOUNDARY}--\r\n".encode()
 
 
 def tg_multipart(method, files, fields=None):
-    """Multipart form upload to Telegram (for sendVoice etc)."""
-    boundary = "----SupervisorBoundary"
-    body = b""
-    for key, val in (fields or {}).items():
-        body += f"--{boundary}\r\nContent-Disposition: form-data; name=\"{key}\"\r\n\r\n{val}\r\n".encode()
+    """Multipart form upload to Telegram (for sendVoice etc).
+
+    File data may be bytes or an open binary file; files are streamed from
+    disk rather than copied into the request body.
+    """
+    parts = [_MP_FIELD.format(key, val).encode() for key, val in (fields or {}).items()]
     for key, (filename, data, content_type) in files.items():
-        body += (
-            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{key}\"; filename=\"{filename}\"\r\n"
-            f"Content-Type: {content_type}\r\n\r\n"
-        ).encode() + data + b"\r\n"
-    body += f"--{boundary}--\r\n".encode()
-
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
-    req = urllib.request.Request(url, data=body, headers={
-        "Content-Type": f"multipart/form-data; boundary={boundary}"
-    })
+        parts += (_MP_FILE.format(key, filename, content_type).encode(), data, b"\r\n")
+    parts.append(_MP_END)
+    body = b"".join(parts) if all(isinstance(p, bytes) for p in parts) else parts
+
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            return json.loads(resp.read())
+        status, data = _tg_request(method, body, _MP_CONTENT_TYPE, 60)
+        if status != 200:
+            log.error("Telegram multipart %s error %s: %s", method, status,
+                      data.decode(errors="replace"))
+            return None
+        return _json_loads(data)
     except Exception as e:
         log.error("Telegram multipart %s failed: %s", method, e)
         return None
 
 
+# Background Telegram calls whose result nobody waits on: typing pings,
+# callback acks and coalesced streaming edits. Chunks in send() stay serial,
+# since Telegram orders messages by arrival.
+_SEND_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="send")
+
+
 def send(chat_id, text, parse_mode=None, reply_markup=None):
     """Send a message, chunking if needed. Returns last message_id."""
     chunks = chunk_text(text, MAX_MSG_LEN)
@@ -115,30 +307,97 @@ def edit_message(chat_id, message_id, text, parse_mode=None):
         text=text, parse_mode=parse_mode)
 
 
+def coalescing_editor(chat_id, message_id):
+    """Return (update, finish) for painting progressive text into a message.
+
+    update(text) never blocks: it stores the text and, if no edit is in
+    flight, hands it to _SEND_POOL. Only the newest pending text is sent, so
+    a slow editMessageText neither stalls the caller nor backlogs stale edits.
+    finish() drops anything pending and waits out an in-flight edit, so it
+    can't land on top of the final message.
+    """
+    lock = threading.Lock()
+    state = {"pending": None, "busy": False, "closed": False}
+    idle = threading.Event()
+    idle.set()
+
+    def flush():
+        while True:
+            with lock:
+                text, state["pending"] = state["pending"], None
+                if text is None or state["closed"]:
+                    state["busy"] = False
+                    idle.set()
+                    return
+            try:
+                edit_message(chat_id, message_id, text)
+            except Exception as e:
+                log.error("Partial edit failed: %s", e)
+
+    def update(text):
+        with lock:
+            if state["closed"]:
+                return
+            state["pending"] = text
+            if state["busy"]:
+                return
+            state["busy"] = True
+            idle.clear()
+        _SEND_POOL.submit(flush)
+
+    def finish():
+        with lock:
+            state["closed"] = True
+            state["pending"] = None
+        idle.wait(HTTP_TIMEOUT)
+
+    return update, finish
+
+
+@functools.lru_cache(maxsize=128)
+def _typing_body(chat_id):
+    return _json_dumps({"chat_id": chat_id, "action": "typing"})
+
+
 def typing(chat_id):
     """Send typing indicator."""
-    tg("sendChatAction", chat_id=chat_id, action="typing")
+    _tg_raw("sendChatAction", _typing_body(chat_id))
+
+
+def typing_pinger(chat_id, done, interval=5):
+    """Re-send the typing indicator every `interval`s until `done` is set."""
+    while not done.wait(interval):
+        typing(chat_id)
 
 
 def chunk_text(text, limit):
     """Split text at word boundaries into chunks of at most `limit` chars."""
     if len(text) <= limit:
         return [text]
+    # Walk offsets over the original string rather than re-slicing the tail,
+    # so total work stays linear in len(text)
     chunks = []
-    while text:
-        if len(text) <= limit:
-            chunks.append(text)
+    start, n = 0, len(text)
+    while start < n:
+        end = start + limit
+        if end >= n:
+            chunks.append(text[start:])
             break
-        cut = text.rfind("\n", 0, limit)
-        if cut < limit // 2:
-            cut = text.rfind(" ", 0, limit)
-        if cut < limit // 4:
-            cut = limit
-        chunks.append(text[:cut])
-        text = text[cut:].lstrip("\n")
+        # Only search where a cut would be accepted: a newline in the back
+        # half, else a space in the back three quarters, else a hard cut
+        cut = text.rfind("\n", start + limit // 2, end)
+        if cut == -1:
+            cut = text.rfind(" ", start + limit // 4, end)
+        if cut == -1:
+            cut = end
+        chunks.append(text[start:cut])
+        start = cut
+        while start < n and text[start] == "\n":
+            start += 1
     return chunks
 
 
+@functools.lru_cache(maxsize=None)
 def make_action_keyboard():
     """Inline keyboard with common actions."""
     return json.dumps({"inline_keyboard": [
@@ -156,118 +415,277 @@ def make_action_keyboard():
 
 # --- Session management ---
 
-sessions = {}  # chat_id -> session_id
-last_voice_response = {}  # chat_id -> last response text (for voice replay)
+# LRU-ordered (oldest first) and capped at MAX_CHATS so stale chats age out
+sessions = collections.OrderedDict()  # chat_id -> session_id
+last_voice_response = collections.OrderedDict()  # chat_id -> last response text (for voice replay)
+
+# Guards mutation + snapshot of the two dicts above; persisted to STATE_PATH
+# so a restart can still --resume Claude sessions.
+_state_lock = threading.Lock()
+
+# chat_id -> generation, bumped by clear_session so a turn that started before
+# /new can't store its session afterwards. Values never repeat, so evicting
+# an entry can't make a stale generation match again.
+_session_gen = collections.OrderedDict()
+_gen_counter = itertools.count(1)
+
+
+def _lru_touch(store, chat_id):
+    """Return store[chat_id] (or None), marking it most recent. Caller holds _state_lock."""
+    value = store.get(chat_id)
+    if value is not None:
+        store.move_to_end(chat_id)
+    return value
+
+
+def _lru_set(store, chat_id, value):
+    """Store and mark most recent, evicting the oldest. Caller holds _state_lock."""
+    store[chat_id] = value
+    store.move_to_end(chat_id)
+    while len(store) > MAX_CHATS:
+        store.popitem(last=False)
+
+
+def get_session(chat_id):
+    """Return (session_id or None, generation); hand the generation to set_session."""
+    with _state_lock:
+        return _lru_touch(sessions, chat_id), _session_gen.get(chat_id, 0)
+
+
+def get_last_voice_response(chat_id):
+    with _state_lock:
+        return _lru_touch(last_voice_response, chat_id)
 
 
 def clear_session(chat_id):
-    sessions.pop(chat_id, None)
+    with _state_lock:
+        sessions.pop(chat_id, None)
+        _lru_set(_session_gen, chat_id, next(_gen_counter))
+        _save_state()
+
+
+def set_session(chat_id, session_id, generation):
+    """Store a turn's session, unless the chat was cleared since get_session."""
+    with _state_lock:
+        if generation != _session_gen.get(chat_id, 0):
+            log.info("Dropping session for chat %d: cleared during the turn", chat_id)
+            return
+        _lru_set(sessions, chat_id, session_id)
+        _save_state()
+
+
+def set_last_voice_response(chat_id, text):
+    with _state_lock:
+        _lru_set(last_voice_response, chat_id, text)
+        _save_state()
+
+
+def _save_state():
+    """Atomically write the state snapshot. Caller holds _state_lock."""
+    tmp = STATE_PATH.with_name(STATE_PATH.name + ".tmp")
+    try:
+        STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps({"sessions": sessions, "last_voice": last_voice_response}))
+        os.replace(tmp, STATE_PATH)
+    except OSError as e:
+        log.error("Failed to save state: %s", e)
+
+
+def load_state():
+    """Restore sessions and voice replays saved by a previous run."""
+    try:
+        data = json.loads(STATE_PATH.read_text())
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log.warning("Ignoring unreadable state file %s: %s", STATE_PATH, e)
+        return
+    # JSON object keys are strings; chat ids are ints. Saved order is LRU order.
+    with _state_lock:
+        for k, v in data.get("sessions", {}).items():
+            _lru_set(sessions, int(k), v)
+        for k, v in data.get("last_voice", {}).items():
+            _lru_set(last_voice_response, int(k), v)
+    log.info("Restored %d session(s) from %s", len(sessions), STATE_PATH)
 
 
 # --- Claude CLI ---
 
+_prompt_cache = {}  # path -> (st_mtime_ns, text)
+
+
 def load_system_prompt():
+    """Return system-prompt.md, re-reading it only when its mtime changes."""
     try:
-        return SYSTEM_PROMPT_PATH.read_text().strip()
+        mtime = SYSTEM_PROMPT_PATH.stat().st_mtime_ns
+        cached = _prompt_cache.get(SYSTEM_PROMPT_PATH)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        text = SYSTEM_PROMPT_PATH.read_text().strip()
     except FileNotFoundError:
         return "You are a supervisor for the OpenClaw gateway. Help diagnose and fix issues."
+    _prompt_cache[SYSTEM_PROMPT_PATH] = (mtime, text)
+    return text
+
+
+_CLAUDE_BASE_CMD = [
+    CLAUDE_BIN, "-p",
+    "--output-format", "stream-json",
+    "--verbose",
+    "--include-partial-messages",
+    "--dangerously-skip-permissions",
+    "--model", "sonnet",
+]
+
+
+# Clean env: unset CLAUDECODE to avoid nested-session detection
+_CLAUDE_ENV = {k: v for k, v in os.environ.items() if k != "CLAUDECODE"}
+_CLAUDE_CWD = str(SUPERVISOR_DIR)
+_CLAUDE_LOG_CMD = " ".join(_CLAUDE_BASE_CMD[:6]) + " ..."
+
+_claude_err = None  # append-mode handle on CLAUDE_ERR_LOG, shared by all runs
+_claude_err_lock = threading.Lock()
+
+
+def _claude_err_log():
+    """Return (handle, offset) for Claude's stderr, opening/rotating lazily.
+
+    The offset is where this run's output starts, so a failure reads back
+    only its own tail. The handle is reopened if the log was deleted or
+    replaced underneath it.
+    """
+    global _claude_err
+    with _claude_err_lock:
+        if _claude_err is not None:
+            st = os.fstat(_claude_err.fileno())
+            try:
+                current = os.stat(CLAUDE_ERR_LOG)
+                moved = (current.st_dev, current.st_ino) != (st.st_dev, st.st_ino)
+            except FileNotFoundError:
+                moved = True
+            if moved or st.st_size > CLAUDE_ERR_MAX:
+                _claude_err.close()
+                _claude_err = None
+                if not moved:
+                    try:
+                        os.replace(CLAUDE_ERR_LOG, CLAUDE_ERR_LOG.with_name(CLAUDE_ERR_LOG.name + ".1"))
+                    except FileNotFoundError:
+                        pass
+        if _claude_err is None:
+            CLAUDE_ERR_LOG.parent.mkdir(parents=True, exist_ok=True)
+            _claude_err = open(CLAUDE_ERR_LOG, "ab", buffering=0)
+        return _claude_err, os.fstat(_claude_err.fileno()).st_size
+
+
+def _claude_err_tail(offset):
+    """Last ~500 chars Claude wrote to stderr since `offset`."""
+    try:
+        with open(CLAUDE_ERR_LOG, "rb") as f:
+            f.seek(max(offset, f.seek(0, os.SEEK_END) - 2048))
+            return f.read().decode(errors="replace").strip()[-500:]
+    except OSError:
+        return ""
 
 
 def run_claude_streaming(chat_id, user_text, on_partial=None):
     """Invoke claude CLI with streaming, call on_partial with progressive text."""
-    session_id = sessions.get(chat_id)
-    system_prompt = load_system_prompt()
-
-    cmd = [
-        CLAUDE_BIN, "-p",
-        "--output-format", "stream-json",
-        "--verbose",
-        "--include-partial-messages",
-        "--dangerously-skip-permissions",
-        "--model", "sonnet",
-    ]
-
+    session_id, generation = get_session(chat_id)
     if session_id:
-        cmd += ["--resume", session_id]
+        cmd = _CLAUDE_BASE_CMD + ["--resume", session_id, user_text]
     else:
-        cmd += ["--append-system-prompt", system_prompt]
-
-    cmd.append(user_text)
-
-    log.info("Claude cmd: %s", " ".join(cmd[:6]) + " ...")
+        cmd = _CLAUDE_BASE_CMD + ["--append-system-prompt", load_system_prompt(), user_text]
 
-    # Clean env: unset CLAUDECODE to avoid nested-session detection
-    env = {k: v for k, v in os.environ.items() if k != "CLAUDECODE"}
+    log.info("Claude cmd: %s", _CLAUDE_LOG_CMD)
 
+    # Claude's stderr is appended straight to a log file: no pipe for the
+    # parent to drain, and nothing copied through Python on the happy path
     try:
+        stderr_file, stderr_offset = _claude_err_log()
         proc = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=str(SUPERVISOR_DIR),
-            env=env,
+            stderr=stderr_file,
+            bufsize=0,
+            cwd=_CLAUDE_CWD,
+            env=_CLAUDE_ENV,
         )
     except Exception as e:
         return f"[error] Failed to start Claude: {e}"
 
     full_text = ""
     new_session_id = None
-    deadline = time.time() + CLAUDE_TIMEOUT
+    deadline = time.monotonic() + CLAUDE_TIMEOUT
 
     try:
-        # Use readline() instead of iterator to avoid Python's read-ahead buffering
-        while True:
-            raw_line = proc.stdout.readline()
-            if not raw_line:
-                break  # EOF
-            if time.time() > deadline:
+        # Raw fd reads into one buffer; complete lines are split off in bulk
+        fd = proc.stdout.fileno()
+        buf = bytearray()
+        eof = False
+        while not eof:
+            # select() bounds the wait too, so a CLI that hangs silently
+            # still hits the deadline instead of blocking in os.read
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
                 proc.kill()
+                proc.wait()
                 return "[timeout] Claude took too long (>5min). Try /new to reset."
+            chunk = os.read(fd, STREAM_READ_SIZE)
+            if chunk:
+                buf.extend(chunk)
+                end = buf.rfind(b"\n")
+                if end == -1:
+                    continue
+            else:
+                eof = True  # flush an unterminated last line
+                end = len(buf)
+            lines = buf[:end].split(b"\n")
+            del buf[:end + 1]
 
-            line = raw_line.decode("utf-8", errors="replace").strip()
-            if not line:
-                continue
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
 
-            try:
-                event = json.loads(line)
-            except json.JSONDecodeError:
-                continue
+                try:
+                    event = _json_loads(line)
+                except ValueError:
+                    continue
 
-            etype = event.get("type", "")
-
-            # Capture session_id from any event
-            if "session_id" in event:
-                new_session_id = event["session_id"]
-
-            if etype == "assistant" and "message" in event:
-                # Extract text from message.content[].text
-                msg = event["message"]
-                if isinstance(msg, dict):
-                    parts = []
-                    for block in msg.get("content", []):
-                        if isinstance(block, dict) and block.get("type") == "text":
-                            parts.append(block.get("text", ""))
-                    text = "".join(parts)
-                    if text:
-                        full_text = text
-                        if on_partial:
-                            on_partial(full_text)
-
-            elif etype == "result":
-                full_text = event.get("result", full_text)
+                etype = event.get("type", "")
+
+                # Capture session_id from any event
                 if "session_id" in event:
                     new_session_id = event["session_id"]
 
+                if etype == "assistant" and "message" in event:
+                    # Extract text from message.content[].text
+                    msg = event["message"]
+                    if isinstance(msg, dict):
+                        parts = []
+                        for block in msg.get("content", []):
+                            if isinstance(block, dict) and block.get("type") == "text":
+                                parts.append(block.get("text", ""))
+                        text = "".join(parts)
+                        if text:
+                            full_text = text
+                            if on_partial:
+                                on_partial(full_text)
+
+                elif etype == "result":
+                    full_text = event.get("result", full_text)
+                    if "session_id" in event:
+                        new_session_id = event["session_id"]
+
     except Exception as e:
         log.error("Streaming read error: %s", e)
 
     proc.wait(timeout=10)
 
     if new_session_id:
-        sessions[chat_id] = new_session_id
+        set_session(chat_id, new_session_id, generation)
 
     if proc.returncode != 0 and not full_text:
-        stderr = proc.stderr.read().decode(errors="replace").strip()[-500:]
+        stderr = _claude_err_tail(stderr_offset)
         log.error("Claude exit %d: %s", proc.returncode, stderr)
         return f"[error] Claude exited with code {proc.returncode}.\n{stderr}"
 
@@ -276,8 +694,18 @@ def run_claude_streaming(chat_id, user_text, on_partial=None):
 
 # --- Supertonic TTS ---
 
+FFMPEG_OGG_CMD = ["ffmpeg", "-i", "pipe:0", "-c:a", "libopus", "-b:a", "48k",
+                  "-application", "voip", "-f", "ogg", "pipe:1"]
+
+
 def text_to_voice(text, lang="en"):
-    """Convert text to WAV bytes using Supertonic TTS. Returns bytes or None."""
+    """Convert text to OGG Opus using Supertonic TTS.
+
+    Returns an open temp file holding the audio (caller closes it), or None.
+    Supertonic's WAV output is piped straight into ffmpeg, which writes to the
+    temp file, so the audio never passes through Python. Without ffmpeg,
+    Supertonic writes its WAV to the temp file and that is returned as-is.
+    """
     if not TTS_SCRIPT.exists():
         log.warning("TTS script not found at %s", TTS_SCRIPT)
         return None
@@ -285,80 +713,199 @@ def text_to_voice(text, lang="en"):
     # Truncate very long text for TTS (keep first ~500 chars)
     tts_text = text[:500] if len(text) > 500 else text
 
+    tts = ffmpeg = None
+    has_ffmpeg = shutil.which(FFMPEG_OGG_CMD[0]) is not None
+    audio = tempfile.TemporaryFile(suffix=".ogg")
     try:
-        proc = subprocess.run(
-            [
-                TTS_PYTHON,
-                str(TTS_SCRIPT),
-                "--onnx-dir", str(TTS_ONNX_DIR),
-                "--voice-style", str(TTS_VOICE_STYLE),
-                "--lang", lang,
-                "--text", tts_text,
-            ],
-            capture_output=True,
-            timeout=30,
-            cwd=str(TTS_SCRIPT.parent),
-        )
-        if proc.returncode == 0 and proc.stdout:
-            # Convert WAV to OGG/Opus for Telegram voice messages
-            return wav_to_ogg(proc.stdout)
-        else:
-            log.error("TTS failed (exit %d): %s", proc.returncode,
-                      proc.stderr.decode(errors="replace")[-200:])
-            return None
+        with tempfile.TemporaryFile() as tts_err:
+            tts = subprocess.Popen(
+                [
+                    TTS_PYTHON,
+                    str(TTS_SCRIPT),
+                    "--onnx-dir", str(TTS_ONNX_DIR),
+                    "--voice-style", str(TTS_VOICE_STYLE),
+                    "--lang", lang,
+                    "--text", tts_text,
+                ],
+                stdout=subprocess.PIPE if has_ffmpeg else audio,
+                stderr=tts_err,  # a file, so a chatty TTS can't stall the pipeline
+                cwd=str(TTS_SCRIPT.parent),
+            )
+            if has_ffmpeg:
+                # Convert WAV to OGG/Opus for Telegram voice messages
+                ffmpeg = subprocess.Popen(
+                    FFMPEG_OGG_CMD,
+                    stdin=tts.stdout,
+                    stdout=audio,
+                    stderr=subprocess.PIPE,
+                )
+                tts.stdout.close()  # ffmpeg owns the read end now
+                _, ffmpeg_err = ffmpeg.communicate(timeout=45)
+                tts.wait(timeout=5)
+            else:
+                log.warning("ffmpeg not found — sending WAV directly")
+                tts.wait(timeout=30)
+            # Only the children wrote to audio, so the on-disk size is exact
+            size = os.fstat(audio.fileno()).st_size
+
+            if tts.returncode != 0 or (not ffmpeg and not size):
+                tts_err.seek(0)
+                log.error("TTS failed (exit %d): %s", tts.returncode,
+                          tts_err.read().decode(errors="replace")[-200:])
+            elif ffmpeg and (ffmpeg.returncode != 0 or not size):
+                log.error("ffmpeg failed: %s", ffmpeg_err.decode(errors="replace")[-200:])
+            else:
+                return audio
     except Exception as e:
         log.error("TTS error: %s", e)
-        return None
-
-
-def wav_to_ogg(wav_bytes):
-    """Convert WAV bytes to OGG Opus using ffmpeg. Returns bytes or None."""
-    try:
-        proc = subprocess.run(
-            ["ffmpeg", "-i", "pipe:0", "-c:a", "libopus", "-b:a", "48k",
-             "-application", "voip", "-f", "ogg", "pipe:1"],
-            input=wav_bytes,
-            capture_output=True,
-            timeout=15,
-        )
-        if proc.returncode == 0 and proc.stdout:
-            return proc.stdout
-        log.error("ffmpeg failed: %s", proc.stderr.decode(errors="replace")[-200:])
-        return None
-    except FileNotFoundError:
-        log.warning("ffmpeg not found — sending WAV directly")
-        return wav_bytes
-    except Exception as e:
-        log.error("ffmpeg error: %s", e)
-        return None
+    finally:
+        for proc in (tts, ffmpeg):
+            if proc and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+    audio.close()
+    return None
 
 
-def send_voice(chat_id, audio_bytes, caption=None):
-    """Send a voice message via Telegram."""
+def send_voice(chat_id, audio, caption=None):
+    """Send a voice message via Telegram. `audio` is bytes or an open binary file."""
     return tg_multipart(
         "sendVoice",
-        files={"voice": ("response.ogg", audio_bytes, "audio/ogg")},
+        files={"voice": ("response.ogg", audio, "audio/ogg")},
         fields={"chat_id": str(chat_id), **({"caption": caption} if caption else {})},
     )
 
 
 # --- Built-in commands (no Claude needed) ---
 
-def check_gateway_health():
-    """Returns (is_healthy: bool, status_text: str)."""
+LOG_DIR = Path.home() / ".openclaw" / "logs"
+TAIL_BLOCK = 8 * 1024  # first read; doubled until n lines fit
+TAIL_CACHE_LINES = 100  # longer tails (e.g. /logs 5000) are read but not cached
+
+_tail_cache = {}  # path -> (st_mtime_ns, st_size, n, last n lines)
+
+
+def tail_lines(path, n):
+    """Return the last n lines of a file, reading backwards from the end.
+
+    Skips the read entirely if the file is unchanged since a call that asked
+    for at least n lines. Raises FileNotFoundError like Path.read_text().
+    """
+    if n <= 0:
+        return []
+    st = os.stat(path)
+    cached = _tail_cache.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size) and cached[2] >= n:
+        return cached[3][-n:]
+
+    size = st.st_size
+    block = TAIL_BLOCK
+    with open(path, "rb") as f:
+        while True:
+            start = max(0, size - block)
+            f.seek(start)
+            data = f.read(size - start).rstrip()
+            if start == 0:
+                data = data.lstrip()
+                break
+            # Enough once there are n full lines after a non-blank prefix
+            # (a blank prefix might be leading whitespace that strip() drops)
+            parts = data.rsplit(b"\n", n)
+            if len(parts) > n and parts[0].strip():
+                data = data[len(parts[0]) + 1:]
+                break
+            block *= 2
+
+    lines = [l.decode(errors="replace") for l in data.splitlines()[-n:]]
+    if n <= TAIL_CACHE_LINES:
+        _tail_cache[path] = (st.st_mtime_ns, st.st_size, n, lines)
+    return lines
+
+
+_GATEWAY_LABEL = b"openclaw.gateway"
+_health_cache = {"t": 0.0, "value": None}
+_health_lock = threading.Lock()
+
+
+def check_gateway_health(force=False):
+    """Returns (is_healthy: bool, status_text: str).
+
+    Results are reused for HEALTH_CACHE_TTL seconds unless force=True.
+    """
+    with _health_lock:
+        if (not force and _health_cache["value"] is not None
+                and time.monotonic() - _health_cache["t"] < HEALTH_CACHE_TTL):
+            return _health_cache["value"]
+        value = _check_gateway_health()
+        _health_cache["t"] = time.monotonic()
+        _health_cache["value"] = value
+        return value
+
+
+def _spawn(cmd):
+    """Start cmd with stdout piped; returns the Popen, or the exception raised."""
+    try:
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except Exception as e:
+        return e
+
+
+def _collect(proc, timeout=5):
+    """Stdout of a _spawn() result, re-raising a spawn failure or timeout."""
+    if isinstance(proc, Exception):
+        raise proc
+    try:
+        return proc.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+
+
+def _reap(proc):
+    """Kill and reap a _spawn() result that was never collected."""
+    if isinstance(proc, subprocess.Popen) and proc.returncode is None:
+        proc.kill()
+        proc.communicate()
+
+
+def _check_gateway_health():
+    # Start both probes at once so their fork/exec and run time overlap
+    launchctl = _spawn([LAUNCHCTL, "list"])
+    lsof = _spawn([LSOF, "-i", ":18789", "-sTCP:LISTEN"])
+    try:
+        return _gateway_report(launchctl, lsof)
+    finally:
+        # An unexpected error (e.g. an unreadable log) mustn't leak the probes
+        _reap(launchctl)
+        _reap(lsof)
+
+
+def _gateway_report(launchctl, lsof):
     lines = []
     healthy = True
 
+    # Read the log tail while the probes run
+    try:
+        last_lines = tail_lines(LOG_DIR / "gateway.err.log", 3)
+    except FileNotFoundError:
+        last_lines = None
+
     # launchctl check
     try:
-        out = subprocess.run(
-            ["launchctl", "list"],
-            capture_output=True, text=True, timeout=5
-        ).stdout
-        gw = [l for l in out.splitlines() if "openclaw.gateway" in l]
-        if gw:
-            parts = gw[0].split()
-            pid, status = parts[0], parts[1]
+        out = _collect(launchctl)
+        # Search the raw bytes and decode only the matching line. The label
+        # is the last column, so require it to end the line; that skips
+        # lookalikes such as "...openclaw.gateway-dev".
+        idx = out.find(_GATEWAY_LABEL)
+        while idx != -1:
+            end = idx + len(_GATEWAY_LABEL)
+            if end == len(out) or out[end:end + 1] in (b"\n", b"\r"):
+                break
+            idx = out.find(_GATEWAY_LABEL, end)
+        if idx != -1:
+            line = out[out.rfind(b"\n", 0, idx) + 1:end]
+            pid, status = line.decode(errors="replace").split(None, 2)[:2]
             if pid == "-":
                 healthy = False
                 lines.append("Gateway: NOT running (no PID)")
@@ -373,10 +920,7 @@ def check_gateway_health():
 
     # Port check
     try:
-        out = subprocess.run(
-            ["lsof", "-i", ":18789", "-sTCP:LISTEN"],
-            capture_output=True, text=True, timeout=5
-        ).stdout.strip()
+        out = _collect(lsof).strip()
         if out:
             lines.append("Port 18789: LISTENING")
         else:
@@ -386,16 +930,12 @@ def check_gateway_health():
         lines.append(f"Port check: failed ({e})")
 
     # Log tail
-    log_path = Path.home() / ".openclaw" / "logs" / "gateway.err.log"
-    try:
-        content = log_path.read_text()
-        last_lines = content.strip().splitlines()[-3:]
-        if last_lines:
-            lines.append("Recent errors:\n" + "\n".join(last_lines))
-        else:
-            lines.append("No recent errors in log.")
-    except FileNotFoundError:
+    if last_lines is None:
         lines.append("Error log not found.")
+    elif last_lines:
+        lines.append("Recent errors:\n" + "\n".join(last_lines))
+    else:
+        lines.append("No recent errors in log.")
 
     return healthy, "\n".join(lines)
 
@@ -405,7 +945,7 @@ def check_relay_health():
     try:
         req = urllib.request.Request("http://127.0.0.1:18792/extension/status", method="GET")
         with urllib.request.urlopen(req, timeout=3) as resp:
-            data = json.loads(resp.read())
+            data = _json_loads(resp.read())
             connected = data.get("connected", False)
             if connected:
                 return True, "Browser Relay: extension connected"
@@ -420,10 +960,8 @@ def check_relay_health():
 def cmd_logs(n=20):
     """Tail recent gateway logs."""
     for name in ["gateway.err.log", "gateway.log"]:
-        path = Path.home() / ".openclaw" / "logs" / name
         try:
-            content = path.read_text()
-            tail = "\n".join(content.strip().splitlines()[-n:])
+            tail = "\n".join(tail_lines(LOG_DIR / name, n))
             if tail:
                 return f"=== {name} (last {n} lines) ===\n{tail}"
         except FileNotFoundError:
@@ -439,27 +977,29 @@ _watchdog_last_state = {
 }
 
 
+_DOWN_KEYBOARD = json.dumps({"inline_keyboard": [
+    [
+        {"text": "Restart", "callback_data": "action:restart"},
+        {"text": "Logs", "callback_data": "action:logs"},
+        {"text": "Diagnose", "callback_data": "action:diagnose"},
+    ]
+]})
+
+
 def watchdog_loop(chat_id):
     """Background thread: checks gateway health periodically, alerts on failure."""
     log.info("Watchdog started (interval=%ds, chat=%d)", HEALTH_CHECK_INTERVAL, chat_id)
     while True:
         try:
             time.sleep(HEALTH_CHECK_INTERVAL)
-            healthy, status = check_gateway_health()
+            healthy, status = check_gateway_health(force=True)
 
             if not healthy and not _watchdog_last_state["alerted"]:
                 # Gateway went down — alert!
                 _watchdog_last_state["healthy"] = False
                 _watchdog_last_state["alerted"] = True
                 log.warning("Watchdog: gateway is DOWN")
-                keyboard = json.dumps({"inline_keyboard": [
-                    [
-                        {"text": "Restart", "callback_data": "action:restart"},
-                        {"text": "Logs", "callback_data": "action:logs"},
-                        {"text": "Diagnose", "callback_data": "action:diagnose"},
-                    ]
-                ]})
-                send(chat_id, f"Gateway is DOWN.\n\n{status}", reply_markup=keyboard)
+                send(chat_id, f"Gateway is DOWN.\n\n{status}", reply_markup=_DOWN_KEYBOARD)
 
             elif healthy and not _watchdog_last_state["healthy"]:
                 # Gateway recovered
@@ -495,6 +1035,66 @@ def watchdog_loop(chat_id):
 
 # --- Main loop ---
 
+def _do_new(chat_id, arg):
+    clear_session(chat_id)
+    send(chat_id, "Session cleared. Fresh start.", reply_markup=make_action_keyboard())
+
+
+def _do_status(chat_id, arg):
+    _, gw_status = check_gateway_health()
+    _, relay_status = check_relay_health()
+    send(chat_id, f"{gw_status}\n\n{relay_status}", reply_markup=make_action_keyboard())
+
+
+def _do_gateway(chat_id, arg):
+    _, status = check_gateway_health()
+    send(chat_id, status, reply_markup=make_action_keyboard())
+
+
+def _do_relay(chat_id, arg):
+    _, status = check_relay_health()
+    send(chat_id, status, reply_markup=make_action_keyboard())
+
+
+def _do_logs(chat_id, arg):
+    n = int(arg.split()[0]) if arg and arg.split()[0].isdigit() else 20
+    send(chat_id, cmd_logs(n))
+
+
+def _do_help(chat_id, arg):
+    send(chat_id, (
+        "/status — gateway + browser relay health\n"
+        "/gateway — gateway status only\n"
+        "/relay — browser relay status only\n"
+        "/logs [N] — tail N lines of gateway logs\n"
+        "/new — clear Claude session\n"
+        "/voice — voice-read last response\n"
+        "Anything else goes to Claude."
+    ), reply_markup=make_action_keyboard())
+
+
+def _do_voice(chat_id, arg):
+    last = get_last_voice_response(chat_id)
+    if last:
+        typing(chat_id)
+        do_voice_reply(chat_id, last)
+    else:
+        send(chat_id, "No previous response to read aloud.")
+
+
+# Lowercased first word -> handler(chat_id, arg)
+_COMMANDS = {
+    "/new": _do_new,
+    "/start": _do_new,
+    "/status": _do_status,
+    "/gateway": _do_gateway,
+    "/relay": _do_relay,
+    "/logs": _do_logs,
+    "/help": _do_help,
+    "/voice": _do_voice,
+}
+
+
 def handle_message(msg):
     chat_id = msg["chat"]["id"]
     user = msg.get("from", {})
@@ -509,107 +1109,114 @@ def handle_message(msg):
         send(chat_id, "Not authorized.")
         return
 
-    log.info("From user %d: %s", user_id, text[:80])
-
-    # Built-in commands
-    if text.lower() in ("/new", "/start"):
-        clear_session(chat_id)
-        send(chat_id, "Session cleared. Fresh start.", reply_markup=make_action_keyboard())
+    log.info("From user %d: %.80s", user_id, text)  # %.80s truncates only if emitted
+
+    # Built-in commands, dispatched on the first word; "/logs50" reads as "/logs 50"
+    head, *rest = text.split(None, 1)
+    head = head.lower()
+    arg = rest[0] if rest else ""
+    if head[:5] == "/logs" and head[5:].isdigit():
+        head, arg = "/logs", head[5:]
+    command = _COMMANDS.get(head)
+    if command:
+        command(chat_id, arg)
         return
 
-    if text.lower() == "/status":
-        _, gw_status = check_gateway_health()
-        _, relay_status = check_relay_health()
-        send(chat_id, f"{gw_status}\n\n{relay_status}", reply_markup=make_action_keyboard())
-        return
+    ask_claude(chat_id, text)
 
-    if text.lower() == "/gateway":
-        _, status = check_gateway_health()
-        send(chat_id, status, reply_markup=make_action_keyboard())
-        return
 
-    if text.lower() == "/relay":
-        _, status = check_relay_health()
-        send(chat_id, status, reply_markup=make_action_keyboard())
-        return
+_serial_queues = {}  # key -> deque of pending (fn, args); present while a drain task runs
+_serial_lock = threading.Lock()
 
-    if text.lower().startswith("/logs"):
-        parts = text.split()
-        n = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 20
-        send(chat_id, cmd_logs(n))
-        return
 
-    if text.lower() == "/help":
-        send(chat_id, (
-            "/status — gateway + browser relay health\n"
-            "/gateway — gateway status only\n"
-            "/relay — browser relay status only\n"
-            "/logs [N] — tail N lines of gateway logs\n"
-            "/new — clear Claude session\n"
-            "/voice — voice-read last response\n"
-            "Anything else goes to Claude."
-        ), reply_markup=make_action_keyboard())
-        return
+def _submit_serial(pool, key, fn, *args):
+    """Run fn(*args) on pool after every task submitted earlier under key.
 
-    if text.lower() == "/voice":
-        last = last_voice_response.get(chat_id)
-        if last:
-            typing(chat_id)
-            do_voice_reply(chat_id, last)
-        else:
-            send(chat_id, "No previous response to read aloud.")
-        return
+    Tasks sharing a key run one at a time in submission order, drained by a
+    single pool task; tasks under different keys run concurrently.
+    """
+    with _serial_lock:
+        queue = _serial_queues.get(key)
+        if queue is not None:
+            queue.append((fn, args))
+            return
+        queue = _serial_queues[key] = collections.deque([(fn, args)])
+    pool.submit(_drain_serial, key, queue)
+
+
+def _drain_serial(key, queue):
+    while True:
+        with _serial_lock:
+            if not queue:
+                del _serial_queues[key]
+                return
+            fn, args = queue.popleft()
+        try:
+            fn(*args)
+        except Exception as e:
+            log.exception("Task for %s failed: %s", key, e)
+
+
+_CLAUDE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="claude")
+
+
+def ask_claude(chat_id, text):
+    """Queue a prompt for Claude; the reply streams into a placeholder message.
 
-    # Send to Claude with streaming
+    Turns run on _CLAUDE_POOL, so the calling update worker is freed at once
+    and at most two Claude CLIs run concurrently. Turns in the same chat are
+    queued and run one at a time in order, so each --resume sees the last.
+    """
+    _submit_serial(_CLAUDE_POOL, ("claude", chat_id), _ask_claude, chat_id, text)
+
+
+def _ask_claude(chat_id, text):
     typing(chat_id)
 
     # Send initial "thinking..." message that we'll edit with streaming content
     placeholder = send(chat_id, "...")
 
     last_edit_time = [0.0]
-    last_edit_text = [""]
+    last_edit_len = [0]
+    if placeholder:
+        push_edit, finish_edits = coalescing_editor(chat_id, placeholder)
 
     def on_partial(text_so_far):
         """Called with progressive response text as Claude streams."""
-        now = time.time()
-        # Throttle edits: every 1.5s and at least 20 new chars
-        if (now - last_edit_time[0] >= 1.5
-                and len(text_so_far) - len(last_edit_text[0]) > 20
+        now = time.monotonic()
+        # Throttle edits: every 3s and at least 500 new chars. The requested
+        # len/5000 s term stays under the 3s floor since edits stop past
+        # MAX_MSG_LEN, so the floor alone is used.
+        if (now - last_edit_time[0] >= 3.0
+                and len(text_so_far) - last_edit_len[0] >= 500
                 and placeholder
                 and len(text_so_far) <= MAX_MSG_LEN):
-            edit_message(chat_id, placeholder, text_so_far + " ...")
+            push_edit(text_so_far + " ...")
             last_edit_time[0] = now
-            last_edit_text[0] = text_so_far
-
-    # Run Claude in a thread so we can keep sending typing indicators
-    result_holder = [None]
-    error_holder = [None]
-
-    def worker():
-        try:
-            result_holder[0] = run_claude_streaming(chat_id, text, on_partial)
-        except Exception as e:
-            error_holder[0] = str(e)
-
-    t = threading.Thread(target=worker)
-    t.start()
+            last_edit_len[0] = len(text_so_far)
 
-    # Send typing every 5s while Claude is working
-    while t.is_alive():
-        t.join(timeout=5)
-        if t.is_alive():
-            typing(chat_id)
+    # Run Claude here; a pool task keeps the typing indicator alive
+    response = error = None
+    done = threading.Event()
+    _SEND_POOL.submit(typing_pinger, chat_id, done)
+    try:
+        response = run_claude_streaming(chat_id, text, on_partial)
+    except Exception as e:
+        error = str(e)
+    finally:
+        done.set()
+        if placeholder:
+            finish_edits()
 
-    if error_holder[0]:
-        log.error("Claude worker error: %s", error_holder[0])
+    if error:
+        log.error("Claude worker error: %s", error)
         if placeholder:
-            edit_message(chat_id, placeholder, f"[error] {error_holder[0]}")
+            edit_message(chat_id, placeholder, f"[error] {error}")
         else:
-            send(chat_id, f"[error] {error_holder[0]}")
-    elif result_holder[0]:
-        response = result_holder[0]
+            send(chat_id, f"[error] {error}")
+    elif response:
         log.info("Sending response (%d chars)", len(response))
-        last_voice_response[chat_id] = response
+        set_last_voice_response(chat_id, response)
 
         if placeholder and len(response) <= MAX_MSG_LEN:
             # Edit the placeholder with final response + action buttons
@@ -631,6 +1238,12 @@ def handle_message(msg):
             send(chat_id, "[error] No response from Claude.")
 
 
+DIAGNOSE_PROMPT = (
+    "The gateway appears to be down. Check launchctl status, read recent error logs, "
+    "check if port 18789 is in use, and tell me what's wrong and how to fix it."
+)
+
+
 def handle_callback(callback_query):
     """Handle inline keyboard button presses."""
     data = callback_query.get("data", "")
@@ -638,8 +1251,8 @@ def handle_callback(callback_query):
     user_id = callback_query["from"]["id"]
     callback_id = callback_query["id"]
 
-    # Acknowledge the button press
-    tg("answerCallbackQuery", callback_query_id=callback_id)
+    # Acknowledge the button press without waiting on the round trip
+    _SEND_POOL.submit(tg, "answerCallbackQuery", callback_query_id=callback_id)
 
     if user_id != ALLOWED_USER:
         return
@@ -647,9 +1260,7 @@ def handle_callback(callback_query):
     log.info("Callback from %d: %s", user_id, data)
 
     if data == "action:status":
-        _, gw_status = check_gateway_health()
-        _, relay_status = check_relay_health()
-        send(chat_id, f"{gw_status}\n\n{relay_status}", reply_markup=make_action_keyboard())
+        _do_status(chat_id, "")
 
     elif data == "action:logs":
         send(chat_id, cmd_logs(20))
@@ -658,11 +1269,11 @@ def handle_callback(callback_query):
         typing(chat_id)
         try:
             proc = subprocess.run(
-                ["launchctl", "kickstart", "-k", "gui/501/ai.openclaw.gateway"],
+                [LAUNCHCTL, "kickstart", "-k", "gui/501/ai.openclaw.gateway"],
                 capture_output=True, text=True, timeout=10
             )
             time.sleep(3)
-            healthy, status = check_gateway_health()
+            healthy, status = check_gateway_health(force=True)
             emoji = "OK" if healthy else "WARN"
             send(chat_id, f"[{emoji}] Restart issued.\n\n{status}",
                  reply_markup=make_action_keyboard())
@@ -674,39 +1285,54 @@ def handle_callback(callback_query):
         send(chat_id, "Session cleared.", reply_markup=make_action_keyboard())
 
     elif data == "action:voice":
-        last = last_voice_response.get(chat_id)
-        if last:
-            typing(chat_id)
-            do_voice_reply(chat_id, last)
-        else:
-            send(chat_id, "No previous response to read aloud.")
+        _do_voice(chat_id, "")
 
     elif data == "action:diagnose":
-        # Ask Claude to diagnose the gateway issue
-        typing(chat_id)
-        handle_message({
-            "chat": {"id": chat_id},
-            "from": {"id": user_id},
-            "text": "The gateway appears to be down. Check launchctl status, read recent error logs, check if port 18789 is in use, and tell me what's wrong and how to fix it.",
-        })
+        # Ask Claude to diagnose the gateway issue (straight to Claude, not
+        # back through handle_message's auth and command routing)
+        ask_claude(chat_id, DIAGNOSE_PROMPT)
+
+
+_ARABIC_RE = re.compile("[\u0600-\u06FF]")
+_HANGUL_RE = re.compile("[\uAC00-\uD7AF]")
 
 
 def do_voice_reply(chat_id, text):
     """Generate and send a voice message from text."""
-    # Detect language (simple heuristic)
+    # Detect language (simple heuristic, first 100 chars)
     lang = "en"
-    if any("\u0600" <= c <= "\u06FF" for c in text[:100]):
+    if _ARABIC_RE.search(text, 0, 100):
         lang = "en"  # Arabic not supported by Supertonic, fall back to English
-    elif any("\uAC00" <= c <= "\uD7AF" for c in text[:100]):
+    elif _HANGUL_RE.search(text, 0, 100):
         lang = "ko"
 
     audio = text_to_voice(text, lang)
     if audio:
-        send_voice(chat_id, audio)
+        with audio:
+            send_voice(chat_id, audio)
     else:
         send(chat_id, "[TTS unavailable — ffmpeg or Supertonic not set up]")
 
 
+_UPDATE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="update")
+
+
+def _update_chat(update):
+    """Chat an update belongs to, or None."""
+    msg = update.get("message") or update.get("callback_query", {}).get("message")
+    return msg["chat"]["id"] if msg else None
+
+
+def handle_update(update):
+    try:
+        if "message" in update:
+            handle_message(update["message"])
+        elif "callback_query" in update:
+            handle_callback(update["callback_query"])
+    except Exception as e:
+        log.exception("Error handling update: %s", e)
+
+
 def poll_loop():
     offset = 0
     log.info("Supervisor bot starting (allowed user: %d)", ALLOWED_USER)
@@ -721,22 +1347,19 @@ def poll_loop():
 
     while True:
         try:
-            resp = tg("getUpdates", offset=offset, timeout=POLL_TIMEOUT,
-                       allowed_updates=json.dumps(["message", "callback_query"]))
+            resp = tg_longpoll(offset)
             if not resp or not resp.get("ok"):
                 log.warning("getUpdates failed, retrying in 5s...")
                 time.sleep(5)
                 continue
 
+            # Hand updates to workers so a long Claude turn never blocks polling.
+            # Chats run concurrently; one chat's updates run in arrival order,
+            # so its prompts reach ask_claude's queue in the order they were sent.
             for update in resp.get("result", []):
                 offset = update["update_id"] + 1
-                try:
-                    if "message" in update:
-                        handle_message(update["message"])
-                    elif "callback_query" in update:
-                        handle_callback(update["callback_query"])
-                except Exception as e:
-                    log.exception("Error handling update: %s", e)
+                _submit_serial(_UPDATE_POOL, ("update", _update_chat(update)),
+                               handle_update, update)
         except KeyboardInterrupt:
             log.info("Shutting down.")
             break
@@ -762,6 +1385,7 @@ def main():
     # Graceful shutdown
     signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
+    load_state()
     poll_loop()
 
 